@@ -1,7 +1,6 @@
 from datetime import datetime
 
 from pydantic import BaseSettings
-from fastapi_mail import ConnectionConfig, FastMail
 
 
 class Settings(BaseSettings):
@@ -9,7 +8,11 @@ class Settings(BaseSettings):
     app_port: int = 8000
     auth_token = "[Put your token here, any string is accepted]"  # this token is used in scheduler calls
     items_per_user: int = 50
-    mail_conf = ConnectionConfig(
+    database_url: str = "sqlite:///./db/subscriptions.db"
+    record_upstream: bool = False  # append raw snapshot/subgraph/calendar responses to an archive, see replay.py
+    record_dir: str = "./db/recordings"
+    delivery_sink_dir: str = ""  # when set, telegram and discord messages are written here instead of being sent
+    mail_conf: dict = dict(  # fastapi_mail ConnectionConfig arguments
         MAIL_USERNAME="[mail@domain.com]",
         MAIL_PASSWORD="[password]",
         MAIL_FROM="[mail@domain.com]",
@@ -29,6 +32,19 @@ class Settings(BaseSettings):
         "limit": 10,
         "url": "https://api.thegraph.com/subgraphs/name/messari/ens-governance"
     }
+    upstream_timeout: float = 10  # seconds a snapshot/subgraph/calendar fetch may take in total
+    upstream_hedge_delay: float = 3  # start a second request if the first has not answered by then
+    upstream_attempts: int = 2
+    upstream_breaker_failure_threshold: int = 3  # failed runs before a source is skipped
+    upstream_breaker_skip_runs: int = 3  # runs a source is skipped once its breaker opens
+    upstream_breaker_max_skip_runs: int = 24  # skipped runs double after every failed retry, up to this
+    mail_queue_size: int = 100  # digest recipients buffered ahead of the senders
+    mail_senders: int = 4  # digest emails sent concurrently
+    render_cache_size: int = 512  # rendered items kept in memory, keyed by content fingerprint
+    profiling_enabled: bool = False  # profile every send run, or pass ?profile=true to profile a single one
+    profile_dir: str = "./db/profiles"
+    profile_keep: int = 50  # oldest profiles beyond this are deleted
+    profile_sample_interval: float = 0.005  # seconds between stack samples
     # https://core.telegram.org/bots#how-do-i-create-a-bot
     telegram_bot_token: str = "[your telegram bot token]"
     telegram_channel_names: dict = {
@@ -42,7 +58,6 @@ class Settings(BaseSettings):
         "offchain": "https://discord.com/api/webhooks/[your discord webhook token]",
         "calendar": "https://discord.com/api/webhooks/[your discord webhook token]"
     }
-    fast_mail = FastMail(mail_conf)
     GOOGLE_API_KEY = "[Google app API key]"  # create one like: https://stackoverflow.com/a/27213635
     GOOGLE_CALENDAR_ID = "8im77u2b3euav0qjc067qb00ic@group.calendar.google.com"  # ENS public calendar ID
     GOOGLE_CALENDAR_START_TIME = datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'  # Get Events from this date
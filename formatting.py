@@ -0,0 +1,119 @@
+import hashlib
+import json
+import re
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+import profiling
+from config import settings
+
+# every platform variant of one item, rendered together from the same normalized record
+Rendered = namedtuple("Rendered", ["telegram", "mail", "mail_html", "discord"])
+
+# markdown v1 escaping as done by python-telegram-bot helpers, without importing the package
+_MARKDOWN_SPECIAL_CHARS = re.compile(r"([_*`\[])")
+
+# fingerprint -> Rendered, least recently used first
+_render_cache = OrderedDict()
+
+
+def escape_markdown(text: str):
+    return _MARKDOWN_SPECIAL_CHARS.sub(r"\\\1", text)
+
+
+@lru_cache
+def get_format_templates():
+    # compile every format template once, on first use
+    from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+    environment = Environment(loader=FileSystemLoader("templates/formats"), autoescape=select_autoescape(["html"]),
+                              keep_trailing_newline=True)
+    environment.filters["escape_md"] = escape_markdown
+    environment.filters["repr"] = repr
+    return {name: environment.get_template(name) for name in environment.list_templates()}
+
+
+def onchain_record(proposal):
+    return {"kind": "onchain", "id": proposal.id, "txnHash": proposal.txnHash, "state": proposal.state,
+            "creationTime": proposal.creationTime, "executionTime": proposal.executionTime,
+            "description": proposal.description}
+
+
+def offchain_record(proposal):
+    return {"kind": "offchain", "id": proposal.id, "ipfs": proposal.ipfs, "link": proposal.link,
+            "title": proposal.title, "body": proposal.body, "choices": proposal.choices, "created": proposal.created,
+            "start": proposal.start, "end": proposal.end, "state": proposal.state, "author": proposal.author,
+            "type": proposal.type, "app": proposal.app, "space": proposal.space}
+
+
+def calendar_record(event: dict):
+    return {"kind": "calendar", "id": event.get('id'), "summary": event.get('summary'),
+            "status": event.get('status'),
+            "start": event.get('start', {}).get('dateTime'), "start_time_zone": event.get('start', {}).get('timeZone'),
+            "end": event.get('end', {}).get('dateTime'), "end_time_zone": event.get('end', {}).get('timeZone'),
+            "event_link": (event.get('htmlLink') or '').replace("/calendar/event?eid=",
+                                                                "/calendar/u/0/r/eventedit/copy/"),
+            "hangout_link": event.get('hangoutLink')}
+
+
+def dump_record(record: dict):
+    return json.dumps(record, sort_keys=True)
+
+
+def fingerprint(record: dict):
+    return hashlib.sha256(dump_record(record).encode()).hexdigest()
+
+
+def render(record: dict):
+    # all platform variants of a record, cached by content fingerprint so an item is escaped
+    # and rendered once no matter how many platforms or digests use it
+    key = fingerprint(record)
+    rendered = _render_cache.get(key)
+    if rendered is not None:
+        _render_cache.move_to_end(key)
+        return rendered
+
+    templates = get_format_templates()
+    kind = record["kind"]
+    with profiling.span("render", kind=kind):
+        telegram = templates[f"{kind}_telegram.md"].render(record)
+        if kind == "offchain":
+            telegram = telegram[:4000]
+        footer_template = templates.get(f"{kind}_discord_footer.md")
+        rendered = Rendered(
+            telegram=telegram,
+            mail=templates[f"{kind}_mail.txt"].render(record),
+            mail_html=templates[f"{kind}_mail.html"].render(record),
+            discord=(templates[f"{kind}_discord_title.md"].render(record).strip(),
+                     templates[f"{kind}_discord_description.md"].render(record)[:2000],
+                     footer_template.render(record)[:2000] if footer_template else None),
+        )
+
+    _render_cache[key] = rendered
+    if len(_render_cache) > settings.render_cache_size:
+        _render_cache.popitem(last=False)
+    return rendered
+
+
+def render_digest(contents):
+    # plain text and html digest bodies from WaitingList contents,
+    # rows saved before records were stored hold the plain mail text itself
+    templates = get_format_templates()
+    plain_parts = []
+    html_parts = []
+    for content in contents:
+        try:
+            record = json.loads(content)
+        except ValueError:
+            record = None
+        if isinstance(record, dict) and "kind" in record:
+            rendered = render(record)
+            plain_parts.append(rendered.mail)
+            html_parts.append(rendered.mail_html)
+        else:
+            plain_parts.append(content)
+            html_parts.append(templates["legacy_mail.html"].render(content=content))
+
+    plain = "".join(f"{part}\n\n\n" for part in plain_parts)
+    html = templates["digest.html"].render(items=html_parts)
+    return plain, html
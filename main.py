@@ -1,43 +1,109 @@
+import asyncio
 import enum
+import time
 import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache
 from typing import List, Annotated
 
 import httpx
-import requests
-import telegram
-import uvicorn
-from fastapi import FastAPI, HTTPException, Depends, Form, Request
-from fastapi_mail import FastMail, MessageSchema, MessageType
+from fastapi import FastAPI, HTTPException, Depends, Form, Query, Request
 from pydantic import EmailStr, BaseModel
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Enum as EnumColumn, Date
+from sqlalchemy import create_engine, event, Column, Integer, String, Boolean, Enum as EnumColumn, Date
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from starlette.background import BackgroundTasks
 from starlette.responses import JSONResponse
 from starlette.staticfiles import StaticFiles
-from discord_webhook import DiscordEmbed, DiscordWebhook
+import formatting
+import profiling
+import recorder
+import upstream
 from config import settings
 from starlette.responses import FileResponse
 from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+
+# heavy clients (fastapi_mail, jinja, discord) are imported and created on first use, not at import,
+# measure with `python startup_profile.py`
 
 
 class EmailSchema(BaseModel):
     email: List[EmailStr]
 
 
-fast_mail = FastMail(settings.mail_conf)
+@lru_cache
+def get_fast_mail():
+    from fastapi_mail import ConnectionConfig, FastMail
+    # configs copied from older samples still hold a ConnectionConfig instead of a dict
+    mail_conf = settings.mail_conf
+    if isinstance(mail_conf, dict):
+        mail_conf = ConnectionConfig(**mail_conf)
+    return FastMail(mail_conf)
+
+
+@lru_cache
+def get_templates():
+    from fastapi.templating import Jinja2Templates
+    return Jinja2Templates(directory="templates")
 
-app = FastAPI()
-templates = Jinja2Templates(directory="templates")
 
 # define the database connection
-SQLALCHEMY_DATABASE_URL = "sqlite:///./db/subscriptions.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(settings.database_url)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+
+# queries are only timed inside a profiled run
+@event.listens_for(engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if profiling.active():
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get("query_started"):
+        profiling.record_span("db.query", conn.info["query_started"].pop(), statement=statement[:80])
+
+
+@event.listens_for(engine, "handle_error")
+def _query_failed(exception_context):
+    # after_cursor_execute does not fire for a failed statement, don't leave its start on the pooled connection
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        profiling.record_span("db.query", conn.info["query_started"].pop(),
+                              statement=(exception_context.statement or "")[:80], error=True)
+
+
+def init_db():
+    # create the database tables
+    Base.metadata.create_all(bind=engine)
+
+
+# settings added after the first config_sample.py, a config.py copied from an older sample lacks them
+NEWER_SETTINGS = ["database_url", "record_upstream", "record_dir", "delivery_sink_dir", "upstream_timeout",
+                  "upstream_hedge_delay", "upstream_attempts", "upstream_breaker_failure_threshold",
+                  "upstream_breaker_skip_runs", "upstream_breaker_max_skip_runs", "mail_queue_size", "mail_senders",
+                  "render_cache_size", "profiling_enabled", "profile_dir", "profile_keep", "profile_sample_interval"]
+
+
+def check_settings():
+    # fail at startup rather than in a background task at send time
+    missing = [name for name in NEWER_SETTINGS if not hasattr(settings, name)]
+    if missing:
+        raise RuntimeError(f"config.py is missing {', '.join(missing)}, re-copy it from config_sample.py")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    check_settings()
+    init_db()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
 app.mount("/assets", StaticFiles(directory="assets"), name="static")
 
 
@@ -95,10 +161,6 @@ class PlatformsSentList(Base):
     created = Column(Date, default=datetime.now)
 
 
-# create the database tables
-Base.metadata.create_all(bind=engine)
-
-
 # define the Pydantic models
 class SubscriptionCreate(BaseModel):
     email: str
@@ -172,14 +234,20 @@ async def get_offchain_proposals():
 
     url = settings.ens_offchain_proposals["url"]
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json={'query': query})
-
-    response_data = response.json()['data']['proposals']
+    async def fetch():
+        if recorder.replaying():
+            return recorder.next_response(recorder.SNAPSHOT, {'data': {'proposals': []}})
+        async with httpx.AsyncClient(timeout=settings.upstream_timeout) as client:
+            response = await client.post(url, json={'query': query})
+        response.raise_for_status()
+        return response.json()
 
-    proposals = [OffchainProposal(**proposal_data) for proposal_data in response_data]
+    def parse(response_json):
+        # error payloads have no data.proposals and count as a failure of the source
+        response_data = response_json['data']['proposals']
+        return [OffchainProposal(**proposal_data) for proposal_data in response_data]
 
-    return proposals
+    return await upstream.call(recorder.SNAPSHOT, fetch, parse, default=[])
 
 
 async def get_onchain_proposals():
@@ -209,14 +277,20 @@ async def get_onchain_proposals():
 
     url = settings.ens_onchain_proposals["url"]
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json={'query': query})
-
-    response_data = response.json()['data']['proposals']
+    async def fetch():
+        if recorder.replaying():
+            return recorder.next_response(recorder.SUBGRAPH, {'data': {'proposals': []}})
+        async with httpx.AsyncClient(timeout=settings.upstream_timeout) as client:
+            response = await client.post(url, json={'query': query})
+        response.raise_for_status()
+        return response.json()
 
-    proposals = [OnchainProposal(**proposal_data) for proposal_data in response_data]
+    def parse(response_json):
+        # error payloads have no data.proposals and count as a failure of the source
+        response_data = response_json['data']['proposals']
+        return [OnchainProposal(**proposal_data) for proposal_data in response_data]
 
-    return proposals
+    return await upstream.call(recorder.SUBGRAPH, fetch, parse, default=[])
 
 
 @app.post("/subscribe/")
@@ -224,11 +298,11 @@ async def subscribe(request: Request, background_tasks: BackgroundTasks, email:
                     onChain: Annotated[bool, Form()] = False,
                     offChain: Annotated[bool, Form()] = False, calendar: Annotated[bool, Form()] = False):
     if (not email):
-        return templates.TemplateResponse("message.html",
+        return get_templates().TemplateResponse("message.html",
                                           {"request": request, "message": "Please enter your email address."})
 
     if (not (offChain or onChain or calendar)):
-        return templates.TemplateResponse("message.html",
+        return get_templates().TemplateResponse("message.html",
                                           {"request": request, "message": "You should select at least one checkbox."})
 
     subscription = Subscription(email=email, onchain=onChain, offchain=offChain, calendar=calendar)
@@ -238,7 +312,7 @@ async def subscribe(request: Request, background_tasks: BackgroundTasks, email:
     # create a new Subscription object and save it to the database
     with SessionLocal() as db:
         if db.query(Subscription).filter_by(email=email).first():
-            return templates.TemplateResponse("message.html",
+            return get_templates().TemplateResponse("message.html",
                                               {"request": request,
                                                "message": "Already subscribed."})
         db_subscription = Subscription(email=subscription.email, onchain=subscription.onchain,
@@ -250,7 +324,7 @@ async def subscribe(request: Request, background_tasks: BackgroundTasks, email:
     # send a verification email to the subscriber
     send_verification_email(subscription.email, token, background_tasks)
 
-    return templates.TemplateResponse("message.html",
+    return get_templates().TemplateResponse("message.html",
                                       {"request": request,
                                        "message": "Verification email has been sent, don't forget to check spams."})
 
@@ -265,20 +339,28 @@ async def unsubscribe(request: Request, token: str):
         if subscription is not None:
             db.delete(subscription)
             db.commit()
-            return templates.TemplateResponse("message.html",
+            return get_templates().TemplateResponse("message.html",
                                               {"request": request, "message": "Unsubscribed successfully."})
 
         # if the subscription was not found, raise an HTTPException
-        return templates.TemplateResponse("message.html",
+        return get_templates().TemplateResponse("message.html",
                                           {"request": request,
                                            "message": "Subscription not found or already unsubscribed."},
                                           status_code=404)
 
 
 async def get_google_calendar_events():
-    try:
-        response = requests.get(settings.GOOGLE_CALENDAR_URL)
-        events_result = response.json()
+    async def fetch():
+        if recorder.replaying():
+            return recorder.next_response(recorder.CALENDAR, {})
+        async with httpx.AsyncClient(timeout=settings.upstream_timeout) as client:
+            response = await client.get(settings.GOOGLE_CALENDAR_URL)
+        response.raise_for_status()
+        return response.json()
+
+    def parse(events_result):
+        if 'error' in events_result:
+            raise ValueError(events_result['error'])
         events = events_result.get('items', [])
 
         if not events:
@@ -287,8 +369,7 @@ async def get_google_calendar_events():
 
         return events
 
-    except requests.exceptions.RequestException as error:
-        print('An error occurred: %s' % error)
+    return await upstream.call(recorder.CALENDAR, fetch, parse, default=[])
 
 
 @app.get("/verify/{token}")
@@ -299,41 +380,33 @@ async def verify(request: Request, token: str, background_tasks: BackgroundTasks
 
         # if the subscription was not found, raise an HTTPException
         if subscription is None:
-            return templates.TemplateResponse("message.html",
+            return get_templates().TemplateResponse("message.html",
                                               {"request": request, "message": "Subscription not found."},
                                               status_code=404)
 
             # if the subscription has already been verified, return a message indicating this
         if subscription.verified:
             send_unsubscibe_link_email(subscription.email, token, background_tasks)
-            return templates.TemplateResponse("message.html",
+            return get_templates().TemplateResponse("message.html",
                                               {"request": request, "message": "Subscription already verified."})
         # set the subscription as verified and update the database
         subscription.verified = True
         db.commit()
 
-    return templates.TemplateResponse("message.html", {"request": request, "message": "Subscription verified."})
+    return get_templates().TemplateResponse("message.html", {"request": request, "message": "Subscription verified."})
 
 
 # define the function to send verification emails
 def send_verification_email(email, token, background_tasks: BackgroundTasks):
-    message = MessageSchema(
-        subject="Verify your email subscription",
-        recipients=[email],
-        body=f'To confirm your subscription, click this link: {settings.app_url}/verify/{token}',
-        subtype=MessageType.plain)
-    background_tasks.add_task(fast_mail.send_message, message)
+    background_tasks.add_task(send_mail, email, "Verify your email subscription",
+                              f'To confirm your subscription, click this link: {settings.app_url}/verify/{token}')
 
 
 def send_unsubscibe_link_email(email, token, background_tasks: BackgroundTasks):
-    message = MessageSchema(
-        subject="Email verified.",
-        recipients=[email],
-        body=f'Your email is verified. You will receive ENS notifications daily.\n'
-             f'If you needed to unsubscribe at any time, here is the link: {settings.app_url}/unsubscribe/{token}',
-        subtype=MessageType.plain)
-
-    background_tasks.add_task(fast_mail.send_message, message)
+    background_tasks.add_task(send_mail, email, "Email verified.",
+                              f'Your email is verified. You will receive ENS notifications daily.\n'
+                              f'If you needed to unsubscribe at any time, here is the link: '
+                              f'{settings.app_url}/unsubscribe/{token}')
 
 
 def mark_as_sent(db_object: PlatformsSentList):
@@ -358,10 +431,15 @@ def set_waiting_as_sent(content_type: ContentType):
 
 
 async def send_telegram_message(channel, message, db_object: PlatformsSentList):
+    if settings.delivery_sink_dir:
+        recorder.write_to_sink("telegram", {"chat_id": channel, "text": message})
+        mark_as_sent(db_object)
+        return
     url = f'https://api.telegram.org/bot{settings.telegram_bot_token}/sendMessage'
     data = {'chat_id': channel, 'text': message, 'parse_mode': 'Markdown'}
     async with httpx.AsyncClient(timeout=20) as client:
-        response = await client.post(url, data=data)
+        with profiling.span("telegram.send", channel=channel):
+            response = await client.post(url, data=data)
         try:
             response.raise_for_status()
             mark_as_sent(db_object)
@@ -372,6 +450,12 @@ async def send_telegram_message(channel, message, db_object: PlatformsSentList):
 
 
 def send_to_discord(title: str, description: str, footer: str, webhook_url: str, db_object: PlatformsSentList):
+    if settings.delivery_sink_dir:
+        recorder.write_to_sink("discord", {"webhook_url": webhook_url, "title": title,
+                                           "description": description, "footer": footer})
+        mark_as_sent(db_object)
+        return
+    from discord_webhook import DiscordEmbed, DiscordWebhook
     try:
         webhook = DiscordWebhook(
             url=webhook_url
@@ -379,7 +463,8 @@ def send_to_discord(title: str, description: str, footer: str, webhook_url: str,
         webhook.add_embed(DiscordEmbed(description=description, title=title))
         if footer:
             webhook.add_embed(DiscordEmbed(description=footer))
-        webhook.execute()
+        with profiling.span("discord.send"):
+            webhook.execute()
         mark_as_sent(db_object)
     except KeyError:
         print("Error or retry later")
@@ -387,12 +472,28 @@ def send_to_discord(title: str, description: str, footer: str, webhook_url: str,
         print("[X] Discord Error:\n>", e)
 
 
+@app.get("/upstream-status")
+async def upstream_status(auth: bool = Depends(authenticate)) -> JSONResponse:
+    return JSONResponse(status_code=200, content=upstream.status())
+
+
+@app.get("/profiles")
+async def profiles(last: int = Query(10, ge=1), auth: bool = Depends(authenticate)) -> JSONResponse:
+    return JSONResponse(status_code=200, content=profiling.summaries(last))
+
+
 @app.get("/send-to-platforms")
 async def send_platform_updates(
-        background_tasks: BackgroundTasks, auth: bool = Depends(authenticate)) -> JSONResponse:
-    await send_onchain(background_tasks)
-    await send_offchain(background_tasks)
-    await send_calendar(background_tasks)
+        background_tasks: BackgroundTasks, profile: bool = False,
+        auth: bool = Depends(authenticate)) -> JSONResponse:
+    recorder.new_run()
+    with profiling.profiled_run("send-to-platforms", profile, background_tasks):
+        with profiling.span("stage.onchain"):
+            await send_onchain(background_tasks)
+        with profiling.span("stage.offchain"):
+            await send_offchain(background_tasks)
+        with profiling.span("stage.calendar"):
+            await send_calendar(background_tasks)
 
 
 async def send_onchain(
@@ -415,74 +516,114 @@ async def send_calendar(
 
 @app.get("/send-emails")
 async def send_emails(
-        background_tasks: BackgroundTasks, auth: bool = Depends(authenticate)) -> JSONResponse:
-    await send_onchain_emails(background_tasks)
-    set_waiting_as_sent(content_type=ContentType.onchain)
-    await send_offchain_emails(background_tasks)
-    set_waiting_as_sent(content_type=ContentType.offchain)
-    await send_calendar_events_emails(background_tasks)
-    set_waiting_as_sent(content_type=ContentType.calendar)
+        background_tasks: BackgroundTasks, profile: bool = False,
+        auth: bool = Depends(authenticate)) -> JSONResponse:
+    with profiling.profiled_run("send-emails", profile, background_tasks):
+        with profiling.span("stage.onchain"):
+            await send_onchain_emails(background_tasks)
+            set_waiting_as_sent(content_type=ContentType.onchain)
+        with profiling.span("stage.offchain"):
+            await send_offchain_emails(background_tasks)
+            set_waiting_as_sent(content_type=ContentType.offchain)
+        with profiling.span("stage.calendar"):
+            await send_calendar_events_emails(background_tasks)
+            set_waiting_as_sent(content_type=ContentType.calendar)
 
     return JSONResponse(status_code=200, content={"message": "send emails initiated."})
 
 
+async def send_mail(email: str, subject: str, body: str, html_body: str = None):
+    # the message is built right before sending, fastapi_mail is only imported once mail goes out
+    from fastapi_mail import MessageSchema, MessageType, MultipartSubtypeEnum
+
+    if html_body is None:
+        message = MessageSchema(
+            subject=subject,
+            recipients=[email],
+            body=body,
+            subtype=MessageType.plain)
+    else:
+        message = MessageSchema(
+            subject=subject,
+            recipients=[email],
+            body=html_body,
+            alternative_body=body,
+            subtype=MessageType.html,
+            multipart_subtype=MultipartSubtypeEnum.alternative)
+    with profiling.span("mail.send"):
+        await get_fast_mail().send_message(message)
+
+
+async def deliver_digest(content_type: ContentType, subject: str, mail_content: str, mail_html: str):
+    # subscribers are read in small batches and handed to a few senders through a bounded queue,
+    # so memory does not grow with the number of subscribers
+    queue = asyncio.Queue(maxsize=settings.mail_queue_size)
+
+    async def produce():
+        last_id = 0
+        while True:
+            # a short session per batch keeps sqlite free for new subscriptions meanwhile
+            with SessionLocal() as db:
+                batch = db.query(Subscription.id, Subscription.email) \
+                    .filter_by(**{content_type.value: True}, verified=True) \
+                    .filter(Subscription.id > last_id) \
+                    .order_by(Subscription.id).limit(settings.mail_queue_size).all()
+            if not batch:
+                break
+            for subscription_id, email in batch:
+                # blocks while the senders are behind
+                await queue.put(email)
+            last_id = batch[-1][0]
+        for _ in range(settings.mail_senders):
+            await queue.put(None)
+
+    async def consume():
+        while (email := await queue.get()) is not None:
+            try:
+                await send_mail(email, subject, mail_content, mail_html)
+            except Exception as e:
+                print(f"[X] Mail Error for {email}:\n>", e)
+
+    # asyncio.TaskGroup needs python 3.11, the image runs 3.9
+    consumers = [asyncio.ensure_future(consume()) for _ in range(settings.mail_senders)]
+    try:
+        await produce()
+        await asyncio.gather(*consumers)
+    finally:
+        # if the producer failed no sentinel was sent, don't leave the senders waiting on the queue
+        for consumer in consumers:
+            consumer.cancel()
+
+
+def send_digest_emails(background_tasks: BackgroundTasks, content_type: ContentType, subject: str):
+    with SessionLocal() as db:
+        waiting_elems = db.query(WaitingList).filter_by(content_type=content_type, sent=False).all()
+    if not waiting_elems:
+        return
+    # plain text and html bodies are built once per digest from the render cache
+    mail_content, mail_html = formatting.render_digest(email.content for email in waiting_elems)
+    background_tasks.add_task(deliver_digest, content_type, subject, mail_content, mail_html)
+
+
 async def send_onchain_emails(
         background_tasks: BackgroundTasks) -> JSONResponse:
-    with SessionLocal() as db:
-        waiting_elems = db.query(WaitingList).filter_by(content_type=ContentType.onchain, sent=False)
-        on_chain_user_emails = db.query(Subscription).filter_by(onchain=True, verified=True)
-    mail_content = ""
-    for email in waiting_elems:
-        mail_content = mail_content + email.content + "\n\n\n"
-    if mail_content:
-        for x in on_chain_user_emails:
-            message = MessageSchema(
-                subject="ENS Domains OnChain Proposals",
-                recipients=[x.email],
-                body=mail_content,
-                subtype=MessageType.plain)
-            background_tasks.add_task(fast_mail.send_message, message)
+    send_digest_emails(background_tasks, ContentType.onchain, "ENS Domains OnChain Proposals")
 
 
 async def send_offchain_emails(
         background_tasks: BackgroundTasks) -> JSONResponse:
-    with SessionLocal() as db:
-        waiting_elems = db.query(WaitingList).filter_by(content_type=ContentType.offchain, sent=False)
-        on_chain_user_emails = db.query(Subscription).filter_by(offchain=True, verified=True)
-    mail_content = ""
-    for email in waiting_elems:
-        mail_content = mail_content + email.content + "\n\n\n"
-    if mail_content:
-        for x in on_chain_user_emails:
-            message = MessageSchema(
-                subject="ENS Domains Offchain Proposals",
-                recipients=[x.email],
-                body=mail_content,
-                subtype=MessageType.plain)
-            background_tasks.add_task(fast_mail.send_message, message)
+    send_digest_emails(background_tasks, ContentType.offchain, "ENS Domains Offchain Proposals")
 
 
 async def send_calendar_events_emails(
         background_tasks: BackgroundTasks) -> JSONResponse:
-    with SessionLocal() as db:
-        waiting_elems = db.query(WaitingList).filter_by(content_type=ContentType.calendar, sent=False)
-        on_chain_user_emails = db.query(Subscription).filter_by(calendar=True, verified=True)
-    mail_content = ""
-    for email in waiting_elems:
-        mail_content = mail_content + email.content + "\n\n\n"
-    if mail_content:
-        for x in on_chain_user_emails:
-            message = MessageSchema(
-                subject="ENS Domains Calendar Events",
-                recipients=[x.email],
-                body=mail_content,
-                subtype=MessageType.plain)
-            background_tasks.add_task(fast_mail.send_message, message)
+    send_digest_emails(background_tasks, ContentType.calendar, "ENS Domains Calendar Events")
 
 
 async def send_on_chain_proposals(background_tasks):
     proposals: List[OnchainProposal] = await get_onchain_proposals()
     for p in proposals:
+        record = formatting.onchain_record(p)
         # look up the subscription by its token
         with SessionLocal() as db:
             if not db.query(PlatformsSentList).filter_by(content_id=p.id, platform=Platform.email,
@@ -490,12 +631,12 @@ async def send_on_chain_proposals(background_tasks):
                 db_object = PlatformsSentList(content_id=p.id, platform=Platform.email,
                                               content_type=ContentType.onchain)
                 waiting_object = WaitingList(content_type=ContentType.onchain,
-                                             content=on_chain_proposals_mail_format(p))
+                                             content=formatting.dump_record(record))
                 background_tasks.add_task(add_to_waiting_list, db_object, waiting_object)
             if not db.query(PlatformsSentList).filter_by(content_id=p.id, platform=Platform.telegram,
                                                          content_type=ContentType.onchain).first():
                 # Send To Telegram
-                tg_message = on_chain_proposals_telegram_format(p)
+                tg_message = formatting.render(record).telegram
                 db_object = PlatformsSentList(content_id=p.id, platform=Platform.telegram,
                                               content_type=ContentType.onchain)
                 background_tasks.add_task(send_telegram_message, settings.telegram_channel_names['onchain'], tg_message,
@@ -503,7 +644,7 @@ async def send_on_chain_proposals(background_tasks):
             # Send To Discord
             if not db.query(PlatformsSentList).filter_by(content_id=p.id, platform=Platform.discord,
                                                          content_type=ContentType.onchain).first():
-                d_title, d_description, d_footer = on_chain_proposals_discord_format(p)
+                d_title, d_description, d_footer = formatting.render(record).discord
                 db_object = PlatformsSentList(content_id=p.id, platform=Platform.discord,
                                               content_type=ContentType.onchain)
                 background_tasks.add_task(send_to_discord, d_title, d_description, d_footer,
@@ -513,6 +654,7 @@ async def send_on_chain_proposals(background_tasks):
 async def send_off_chain_proposals(background_tasks):
     proposals: List[OffchainProposal] = await get_offchain_proposals()
     for p in proposals:
+        record = formatting.offchain_record(p)
         # look up the subscription by its token
         with SessionLocal() as db:
             if not db.query(PlatformsSentList).filter_by(content_id=p.id, platform=Platform.email,
@@ -520,13 +662,13 @@ async def send_off_chain_proposals(background_tasks):
                 db_object = PlatformsSentList(content_id=p.id, platform=Platform.email,
                                               content_type=ContentType.offchain)
                 waiting_object = WaitingList(content_type=ContentType.offchain,
-                                             content=off_chain_proposals_mail_format(p))
+                                             content=formatting.dump_record(record))
                 background_tasks.add_task(add_to_waiting_list, db_object, waiting_object)
 
             if not db.query(PlatformsSentList).filter_by(content_id=p.id, platform=Platform.telegram,
                                                          content_type=ContentType.offchain).first():
                 # Send To Telegram
-                tg_message = off_chain_proposals_telegram_format(p)
+                tg_message = formatting.render(record).telegram
                 db_object = PlatformsSentList(content_id=p.id, platform=Platform.telegram,
                                               content_type=ContentType.offchain)
                 background_tasks.add_task(send_telegram_message, settings.telegram_channel_names['offchain'],
@@ -535,7 +677,7 @@ async def send_off_chain_proposals(background_tasks):
             # Send To Discord
             if not db.query(PlatformsSentList).filter_by(content_id=p.id, platform=Platform.discord,
                                                          content_type=ContentType.offchain).first():
-                d_title, d_description, d_footer = off_chain_proposals_discord_format(p)
+                d_title, d_description, d_footer = formatting.render(record).discord
                 db_object = PlatformsSentList(content_id=p.id, platform=Platform.discord,
                                               content_type=ContentType.offchain)
                 background_tasks.add_task(send_to_discord, d_title, d_description, d_footer,
@@ -546,18 +688,19 @@ async def send_calendar_events(background_tasks):
     calendar_events = await get_google_calendar_events()
     for event in calendar_events:
         if event.get('status', '') != 'cancelled':
+            record = formatting.calendar_record(event)
             with SessionLocal() as db:
                 if not db.query(PlatformsSentList).filter_by(content_id=event.get('id'), platform=Platform.email,
                                                              content_type=ContentType.calendar).first():
                     db_object = PlatformsSentList(content_id=event.get('id'), platform=Platform.email,
                                                   content_type=ContentType.calendar)
                     waiting_object = WaitingList(content_type=ContentType.calendar,
-                                                 content=calendar_mail_format(event))
+                                                 content=formatting.dump_record(record))
                     background_tasks.add_task(add_to_waiting_list, db_object, waiting_object)
                 if not db.query(PlatformsSentList).filter_by(content_id=event.get('id'), platform=Platform.telegram,
                                                              content_type=ContentType.calendar).first():
                     # Send To Telegram
-                    tg_message = calendar_telegram_format(event)
+                    tg_message = formatting.render(record).telegram
                     db_object = PlatformsSentList(content_id=event.get('id'), platform=Platform.telegram,
                                                   content_type=ContentType.calendar)
                     background_tasks.add_task(send_telegram_message, settings.telegram_channel_names['calendar'],
@@ -566,123 +709,14 @@ async def send_calendar_events(background_tasks):
                 # Send To Discord
                 if not db.query(PlatformsSentList).filter_by(content_id=event.get('id'), platform=Platform.discord,
                                                              content_type=ContentType.calendar).first():
-                    d_title, d_description, d_footer = calendar_discord_format(event)
+                    d_title, d_description, d_footer = formatting.render(record).discord
                     db_object = PlatformsSentList(content_id=event.get('id'), platform=Platform.discord,
                                                   content_type=ContentType.calendar)
                     background_tasks.add_task(send_to_discord, d_title, d_description, d_footer,
                                               settings.discord_channels['calendar'], db_object)
 
 
-def on_chain_proposals_telegram_format(proposal: OnchainProposal):
-    return f"""
-{telegram.helpers.escape_markdown(proposal.description[:3200], version=1)}
------------------------------
-*id*: "{proposal.id}"
-*txnHash*: "{proposal.txnHash}"
-*state*: "{proposal.state}"
-*creationTime*: {proposal.creationTime}
-*executionTime*: {proposal.executionTime}
-            """
-
-
-def on_chain_proposals_mail_format(proposal: OnchainProposal):
-    return f"""
-{proposal.description}
-*id*: "{proposal.id}"
-*txnHash*: "{proposal.txnHash}"
-*state*: "{proposal.state}"
-*creationTime*: {proposal.creationTime}
-*executionTime*: {proposal.executionTime}
-            """
-
-
-def on_chain_proposals_discord_format(proposal: OnchainProposal):
-    description = proposal.description[:2000]
-    footer = f"""
-*id*: "{proposal.id}"
-*txnHash*: "{proposal.txnHash}"
-*state*: "{proposal.state}"
-*creationTime*: {proposal.creationTime}
-*executionTime*: {proposal.executionTime}
-"""[:2000]
-    title = "Proposal"
-    return title, description, footer
-
-
-def off_chain_proposals_telegram_format(proposal: OffchainProposal):
-    return f"""
-*{telegram.helpers.escape_markdown(proposal.title)}* _(state:{proposal.state})_
-*space*: {proposal.space.__repr__()} ,*type*: {proposal.type}
-*app*: {proposal.app}, *author*: {proposal.author}      
-*start*: {proposal.start} ,*end*: {proposal.end} ,*created*: {proposal.created}
-
-{telegram.helpers.escape_markdown(proposal.body[:3100])}
-*choices*: {''.join(proposal.choices)[:500]} 
---------
-*ipfs*: {proposal.ipfs}
-*link*: {proposal.link}
-*id*: {proposal.id}
-            """[:4000]
-
-
-def off_chain_proposals_mail_format(proposal: OffchainProposal):
-    return f"""
-*{proposal.title}* _(state:{proposal.state})_
-*space*: {proposal.space.__repr__()} ,*type*: {proposal.type}
-*app*: {proposal.app}, *author*: {proposal.author}      
-*start*: {proposal.start} ,*end*: {proposal.end} ,*created*: {proposal.created}
-{proposal.body}
-*choices*: {''.join(proposal.choices)} 
---------
-*ipfs*: {proposal.ipfs}
-*link*: {proposal.link}
-*id*: {proposal.id}
-            """
-
-
-def off_chain_proposals_discord_format(proposal: OffchainProposal):
-    description = proposal.body[:2000]
-    footer = f"""
-*choices*: {proposal.choices} 
-*ipfs*: {proposal.ipfs}
-*link*: {proposal.link}
-*id*: {proposal.id}
-    """[:2000]
-    title = f"*{proposal.title}* _(state:{proposal.state})_"
-    return title, description, footer
-
-
-def calendar_mail_format(event: dict):
-    return f"""
-{event.get('summary')} _(Status: {event.get('status')})_
-Start: {event.get('start', {}).get('dateTime')} (timeZone:{event.get('start', {}).get('timeZone')})
-End: {event.get('end', {}).get('dateTime')} (timeZone:{event.get('end', {}).get('timeZone')})
-Event Link: {event.get('htmlLink').replace("/calendar/event?eid=", "/calendar/u/0/r/eventedit/copy/")}
-hangoutLink: {event.get('hangoutLink')}
-        """
-
-
-def calendar_telegram_format(event: dict):
-    return f"""
-{event.get('summary')} _(Status: {event.get('status')})_
-Start: {event.get('start', {}).get('dateTime')} (timeZone:{event.get('start', {}).get('timeZone')})
-End: {event.get('end', {}).get('dateTime')} (timeZone:{event.get('end', {}).get('timeZone')})
-Event Link: {event.get('htmlLink').replace("/calendar/event?eid=", "/calendar/u/0/r/eventedit/copy/")}
-hangoutLink: {event.get('hangoutLink')}
-        """
-
-
-def calendar_discord_format(event: dict):
-    title = f"{event.get('summary')} _(Status: {event.get('status')})_"
-    description = f"""
-Start: {event.get('start', {}).get('dateTime')} (timeZone:{event.get('start', {}).get('timeZone')})
-End: {event.get('end', {}).get('dateTime')} (timeZone:{event.get('end', {}).get('timeZone')})
-Event Link: {event.get('htmlLink').replace("/calendar/event?eid=", "/calendar/u/0/r/eventedit/copy/")}
-hangoutLink: {event.get('hangoutLink')}
-        """
-    return title, description, None
-
-
 # run the app
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=settings.app_port)
@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from starlette.background import BackgroundTask
+
+from config import settings
+
+# the profile of the run being handled, None when profiling is off. background tasks of the same
+# request run in a copy of this context, so their spans land in the same run
+_current_run = ContextVar("current_run", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+class _Sampler(threading.Thread):
+    # periodically folds the stack of every busy thread into "file:function;..." counts
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        # samples of the event loop waiting in select, kept out of the stacks so they don't hide the work
+        self.io_wait = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                # skip the sampler and idle pool workers blocked in threading
+                if thread_id == own_id or frame.f_code.co_filename.endswith("threading.py"):
+                    continue
+                if frame.f_code.co_filename.endswith("selectors.py"):
+                    self.io_wait += 1
+                    continue
+                self.stacks[_fold(frame)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _fold(frame):
+    names = []
+    while frame is not None:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RunProfile:
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.finished = False
+        self.sampler = _Sampler(settings.profile_sample_interval)
+        self.sampler.start()
+
+    def add_span(self, name: str, started: float, ended: float, parent, span_id, attrs: dict):
+        self.spans.append({"id": span_id, "parent": parent, "name": name,
+                           "start_ms": round((started - self.started) * 1000, 3),
+                           "duration_ms": round((ended - started) * 1000, 3), "attrs": attrs})
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.sampler.stop()
+        duration_ms = round((time.perf_counter() - self.started) * 1000, 3)
+        os.makedirs(settings.profile_dir, exist_ok=True)
+        path = os.path.join(settings.profile_dir, f"{self.started_at:%Y%m%dT%H%M%S%f}-{self.name}.json")
+        with open(path, "w", encoding="utf-8") as profile_file:
+            json.dump({"name": self.name, "started_at": self.started_at.isoformat(), "duration_ms": duration_ms,
+                       "spans": self.spans, "samples": dict(self.sampler.stacks.most_common(200)),
+                       "io_wait_samples": self.sampler.io_wait}, profile_file)
+        _rotate()
+
+
+def _profile_files():
+    if not os.path.isdir(settings.profile_dir):
+        return []
+    return sorted(os.path.join(settings.profile_dir, name) for name in os.listdir(settings.profile_dir)
+                  if name.endswith(".json"))
+
+
+def _rotate():
+    for path in _profile_files()[:-settings.profile_keep]:
+        os.remove(path)
+
+
+@contextmanager
+def profiled_run(name: str, requested: bool, background_tasks):
+    # profiling is opt-in, per request or for every run through settings. the run ends after the
+    # request's background tasks, or right away if the request itself fails
+    run = RunProfile(name) if requested or settings.profiling_enabled else None
+    _current_run.set(run)
+    _current_span.set(None)
+    if run is None:
+        yield
+        return
+    try:
+        yield
+    except BaseException:
+        run.finish()
+        raise
+    _finish_after(background_tasks, run)
+
+
+def _finish_after(background_tasks, run):
+    # starlette stops at the first failing background task, so the tasks run inside one task
+    # that always finishes the run, otherwise the sampler thread would be left running
+    tasks = list(background_tasks.tasks)
+
+    async def run_tasks():
+        try:
+            for task in tasks:
+                await task()
+        finally:
+            run.finish()
+
+    background_tasks.tasks[:] = [BackgroundTask(run_tasks)]
+
+
+@contextmanager
+def span(name: str, **attrs):
+    run = _current_run.get()
+    if run is None:
+        yield
+        return
+    span_id = uuid.uuid4().hex[:8]
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        run.add_span(name, started, time.perf_counter(), parent, span_id, attrs)
+
+
+def active():
+    return _current_run.get() is not None
+
+
+def record_span(name: str, started: float, **attrs):
+    # for timings measured outside a with block, e.g. sqlalchemy cursor events
+    run = _current_run.get()
+    if run is not None:
+        run.add_span(name, started, time.perf_counter(), _current_span.get(), uuid.uuid4().hex[:8], attrs)
+
+
+def summaries(last: int):
+    result = []
+    # a slice with 0 or a negative number would return (nearly) every profile
+    if last < 1:
+        return result
+    for path in reversed(_profile_files()[-last:]):
+        with open(path, encoding="utf-8") as profile_file:
+            profile = json.load(profile_file)
+        stages = {}
+        for item in profile["spans"]:
+            stage = stages.setdefault(item["name"], {"count": 0, "total_ms": 0})
+            stage["count"] += 1
+            stage["total_ms"] = round(stage["total_ms"] + item["duration_ms"], 3)
+        result.append({"file": os.path.basename(path), "name": profile["name"], "started_at": profile["started_at"],
+                       "duration_ms": profile["duration_ms"], "stages": stages,
+                       "top_stacks": list(profile["samples"].items())[:5],
+                       "io_wait_samples": profile.get("io_wait_samples", 0)})
+    return result
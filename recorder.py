@@ -0,0 +1,87 @@
+import gzip
+import json
+import os
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+
+from config import settings
+
+# upstream sources, named after the service that answered
+SNAPSHOT = "snapshot"
+SUBGRAPH = "subgraph"
+CALENDAR = "calendar"
+
+# recorded responses waiting to be fed back, per source (None when not replaying)
+_replay_queues = None
+
+# id of the /send-to-platforms run the recorded responses belong to
+_run_id = ContextVar("run_id", default=None)
+
+
+def new_run():
+    _run_id.set(uuid.uuid4().hex)
+
+
+def record_response(source: str, payload):
+    # append a raw upstream response to today's compressed archive
+    if not settings.record_upstream:
+        return
+    os.makedirs(settings.record_dir, exist_ok=True)
+    path = os.path.join(settings.record_dir, f"{datetime.utcnow():%Y-%m-%d}.jsonl.gz")
+    line = json.dumps({"ts": time.time(), "run": _run_id.get(), "source": source, "payload": payload})
+    # every append adds a new gzip member, gzip.open reads them back as one stream
+    with gzip.open(path, "at", encoding="utf-8") as archive:
+        archive.write(line + "\n")
+
+
+def read_archives(paths):
+    records = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as archive:
+            for line in archive:
+                if line.strip():
+                    records.append(json.loads(line))
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+
+def group_runs(records):
+    # records are grouped by the run that fetched them, runs ordered by their first record.
+    # a run may miss sources, e.g. ones skipped by an open circuit breaker
+    runs = {}
+    for record in records:
+        runs.setdefault(record.get("run"), {})[record["source"]] = record
+    return list(runs.values())
+
+
+def start_replay():
+    global _replay_queues
+    _replay_queues = {SNAPSHOT: deque(), SUBGRAPH: deque(), CALENDAR: deque()}
+
+
+def queue_run(run: dict):
+    # make the next fetch of every source return the payloads recorded for this run
+    for source, record in run.items():
+        _replay_queues.setdefault(source, deque()).append(record["payload"])
+
+
+def replaying():
+    return _replay_queues is not None
+
+
+def next_response(source: str, default):
+    queue = _replay_queues.get(source)
+    if not queue:
+        return default
+    return queue.popleft()
+
+
+def write_to_sink(platform: str, message: dict):
+    # local stand-in for telegram / discord delivery
+    os.makedirs(settings.delivery_sink_dir, exist_ok=True)
+    path = os.path.join(settings.delivery_sink_dir, f"{platform}.jsonl")
+    with open(path, "a", encoding="utf-8") as sink:
+        sink.write(json.dumps({"ts": time.time(), **message}) + "\n")
@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import recorder
+from config import settings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded upstream responses through /send-to-platforms.")
+    parser.add_argument("archives", nargs="+", help="recorded .jsonl.gz archives (glob patterns allowed)")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="1 replays at recorded speed, 60 a minute per second, 0 as fast as possible")
+    parser.add_argument("--db", help="sqlite database used instead of the real one, a fresh temporary one by default")
+    parser.add_argument("--reuse-db", action="store_true",
+                        help="allow an existing --db, items already sent there are not rendered or delivered again")
+    parser.add_argument("--profile", action="store_true", help="write a profile of every run to profile_dir")
+    parser.add_argument("--sink", default="./db/replay_sink", help="directory receiving telegram/discord messages")
+    return parser.parse_args()
+
+
+async def replay(runs, speed: float, profile: bool):
+    # imported late so the overridden settings are in place before the engine is created
+    import main
+    from starlette.background import BackgroundTasks
+    main.init_db()
+
+    previous_ts = None
+    for number, run in enumerate(runs, start=1):
+        run_ts = min(record["ts"] for record in run.values())
+        if speed and previous_ts is not None:
+            await asyncio.sleep(max(run_ts - previous_ts, 0) / speed)
+        previous_ts = run_ts
+
+        recorder.queue_run(run)
+        background_tasks = BackgroundTasks()
+        started = time.perf_counter()
+        await main.send_platform_updates(background_tasks, profile)
+        await background_tasks()
+        print(f"run {number}/{len(runs)} ({', '.join(sorted(run))}) took {time.perf_counter() - started:.3f}s")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # never let a replay touch the real subscribers, channels or archive
+    # a database left from an earlier replay already has every item marked as sent
+    if args.db is None:
+        args.db = os.path.join(tempfile.mkdtemp(prefix="ensify-replay-"), "replay.db")
+    elif os.path.exists(args.db) and not args.reuse_db:
+        sys.exit(f"{args.db} already exists, remove it or pass --reuse-db")
+    settings.database_url = f"sqlite:///{args.db}"
+    settings.delivery_sink_dir = args.sink
+    settings.record_upstream = False
+
+    # every replay starts with empty sink files instead of appending to the previous ones
+    for platform in ("telegram", "discord"):
+        sink_path = os.path.join(args.sink, f"{platform}.jsonl")
+        if os.path.exists(sink_path):
+            os.remove(sink_path)
+    print(f"replaying into {args.db}, messages in {args.sink}")
+
+    paths = sorted(path for pattern in args.archives for path in glob.glob(pattern))
+    runs = recorder.group_runs(recorder.read_archives(paths))
+    recorder.start_replay()
+    asyncio.run(replay(runs, args.speed, args.profile))
@@ -0,0 +1,51 @@
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+
+# packages main.py only needs once mail, pages or discord messages go out. wall clock time differs
+# too much between machines to gate on, so the budget is that none of these load on `import main`
+DEFERRED_PACKAGES = ["fastapi_mail", "jinja2", "discord_webhook", "telegram", "requests"]
+
+
+def import_times(module: str):
+    # run in a fresh interpreter so nothing is already cached in sys.modules
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    rows = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report what `import main` spends its cold start on.")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    rows = import_times(args.module)
+    total_ms = sum(self_us for self_us, _, _ in rows) / 1000
+
+    per_package = defaultdict(int)
+    for self_us, _, name in rows:
+        per_package[name.strip().split(".")[0]] += self_us
+
+    print(f"top {args.top} packages by import time:")
+    for package, self_us in sorted(per_package.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {package}")
+    print(f"total: {total_ms:.1f} ms")
+
+    loaded = [package for package in DEFERRED_PACKAGES if package in per_package]
+    if loaded:
+        sys.exit(f"imported at startup but should be deferred: {', '.join(loaded)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import enum
+from datetime import datetime
+
+import profiling
+import recorder
+from config import settings
+
+
+class BreakerState(enum.Enum):
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, source: str):
+        self.source = source
+        self.state = BreakerState.closed
+        self.failures = 0
+        # runs still to skip while open, and how many the next opening skips
+        self.skips_left = 0
+        self.cooldown_runs = settings.upstream_breaker_skip_runs
+        self.last_error = None
+        self.last_success = None
+        self.last_failure = None
+
+    def allow_request(self):
+        # the cool down is counted in skipped runs, so it holds whatever the schedule interval is.
+        # after it a single trial request decides whether the upstream is back
+        if self.state == BreakerState.open:
+            if self.skips_left > 0:
+                self.skips_left -= 1
+                return False
+            self.state = BreakerState.half_open
+        return True
+
+    def record_success(self):
+        self.state = BreakerState.closed
+        self.failures = 0
+        self.cooldown_runs = settings.upstream_breaker_skip_runs
+        self.last_success = datetime.utcnow()
+
+    def record_failure(self, error: Exception):
+        self.failures += 1
+        self.last_error = repr(error)
+        self.last_failure = datetime.utcnow()
+        if self.state == BreakerState.half_open:
+            # the trial failed, back off twice as long as last time
+            self.cooldown_runs = min(self.cooldown_runs * 2, settings.upstream_breaker_max_skip_runs)
+        elif self.failures < settings.upstream_breaker_failure_threshold:
+            return
+        self.state = BreakerState.open
+        self.skips_left = self.cooldown_runs
+
+
+breakers = {source: CircuitBreaker(source) for source in (recorder.SNAPSHOT, recorder.SUBGRAPH, recorder.CALENDAR)}
+
+# source -> (parsed result, time it was fetched)
+_last_good = {}
+
+
+async def _hedged_fetch(fetch, attempts: int):
+    # start another request when the running ones are slower than the hedge delay or have failed,
+    # the first successful response wins
+    pending = {asyncio.ensure_future(fetch())}
+    launched = 1
+    error = None
+    try:
+        while pending:
+            wait_timeout = settings.upstream_hedge_delay if launched < attempts else None
+            done, pending = await asyncio.wait(pending, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if launched < attempts:
+                pending.add(asyncio.ensure_future(fetch()))
+                launched += 1
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call(source: str, fetch, parse, default):
+    # fetch and parse one upstream source behind its circuit breaker. never raises: on an open
+    # breaker, timeout or bad payload the last good result (or `default`) is returned instead
+    breaker = breakers[source]
+    # a replay feeds every recorded run through, skipping a source would leave its payload queued
+    # for the next run
+    if not recorder.replaying() and not breaker.allow_request():
+        return _last_good.get(source, (default,))[0]
+
+    # a replayed response must be consumed exactly once
+    attempts = 1 if recorder.replaying() else settings.upstream_attempts
+    try:
+        with profiling.span(f"upstream.{source}"):
+            payload = await asyncio.wait_for(_hedged_fetch(fetch, attempts), settings.upstream_timeout)
+        recorder.record_response(source, payload)
+        result = parse(payload)
+    except Exception as error:
+        breaker.record_failure(error)
+        print(f"[X] {source} upstream failed ({breaker.state.value}):\n>", repr(error))
+        return _last_good.get(source, (default,))[0]
+
+    breaker.record_success()
+    _last_good[source] = (result, datetime.utcnow())
+    return result
+
+
+def status():
+    return {
+        source: {
+            "state": breaker.state.value,
+            "failures": breaker.failures,
+            "skipped_runs_left": breaker.skips_left,
+            "last_error": breaker.last_error,
+            "last_failure": breaker.last_failure.isoformat() if breaker.last_failure else None,
+            "last_success": breaker.last_success.isoformat() if breaker.last_success else None,
+            "last_good_cached_at": _last_good[source][1].isoformat() if source in _last_good else None,
+        }
+        for source, breaker in breakers.items()
+    }